@@ -2,6 +2,8 @@
 
 # Standard library and system-related imports
 import subprocess  # Used to run system commands (like Wi-Fi scanning)
+import concurrent.futures  # Runs slow Wi-Fi work off the main loop
+import collections
 import dbus        # Python D-Bus bindings for interacting with BlueZ
 import dbus.exceptions
 import dbus.mainloop.glib
@@ -10,6 +12,25 @@ import time
 from gi.repository import GLib  # For main event loop integration
 import re       # Used for parsing Wi-Fi scan results
 import json     # Optional: used for future JSON formatting of data
+import logging
+import logging.handlers
+import queue
+import threading
+import sys
+
+# ── Logging ──────────────────────────────────────────────────────────────────
+# D-Bus handlers only put records on a queue; a listener thread writes them
+# to stdout, so a slow (e.g. serial) console never stalls the main loop.
+
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+
+log = logging.getLogger('ble_gatt_server')
+log.setLevel(logging.INFO)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.propagate = False
 
 # ── Constants for D-Bus BlueZ Interfaces ──────────────────────────────────────
 
@@ -20,6 +41,55 @@ LE_ADVERTISING_MANAGER_IFACE   = 'org.bluez.LEAdvertisingManager1'
 GATT_SERVICE_IFACE             = 'org.bluez.GattService1'
 GATT_CHRC_IFACE                = 'org.bluez.GattCharacteristic1'
 ADVERTISING_IFACE              = 'org.bluez.LEAdvertisement1'
+DBUS_PROP_IFACE                = 'org.freedesktop.DBus.Properties'
+
+# ── Constants for D-Bus NetworkManager Interfaces ────────────────────────────
+
+NM_SERVICE_NAME                = 'org.freedesktop.NetworkManager'
+NM_PATH                        = '/org/freedesktop/NetworkManager'
+NM_IFACE                       = 'org.freedesktop.NetworkManager'
+NM_DEVICE_IFACE                = 'org.freedesktop.NetworkManager.Device'
+NM_WIRELESS_IFACE              = 'org.freedesktop.NetworkManager.Device.Wireless'
+NM_AP_IFACE                    = 'org.freedesktop.NetworkManager.AccessPoint'
+NM_SETTINGS_PATH               = '/org/freedesktop/NetworkManager/Settings'
+NM_SETTINGS_IFACE              = 'org.freedesktop.NetworkManager.Settings'
+NM_SETTINGS_CONNECTION_IFACE   = 'org.freedesktop.NetworkManager.Settings.Connection'
+NM_DEVICE_TYPE_WIFI            = 2
+NM_ACTIVE_CONN_IFACE           = 'org.freedesktop.NetworkManager.Connection.Active'
+NM_ACTIVE_CONNECTION_STATE_ACTIVATED   = 2
+NM_ACTIVE_CONNECTION_STATE_DEACTIVATED = 4
+NM_AP_FLAGS_PRIVACY            = 0x1
+NM_AP_SEC_KEY_MGMT_PSK         = 0x100
+NM_AP_SEC_KEY_MGMT_SAE         = 0x400
+
+# ── Wi-Fi scan cache ─────────────────────────────────────────────────────────
+# Scanning takes hundreds of milliseconds, so the last result is reused
+# for a short while instead of rescanning on every request.
+
+SCAN_CACHE_TTL = 10.0  # Seconds a scan result stays valid
+SCAN_WAIT_TIMEOUT = 5.0  # Seconds to wait for a requested rescan to finish
+_scan_cache = {"ts": 0.0, "networks": []}
+
+# Matches one `iwlist` cell: its MAC address and the ESSID of that same cell.
+# The tempered dot stops at the next "Cell NN - " so a cell without an
+# ESSID line is skipped instead of borrowing the next cell's name.
+_CELL_RE = re.compile(
+    r'Cell \d+ - Address: ([\da-fA-F:]{17})'
+    r'(?:(?!Cell \d+ - ).)*?ESSID:"([^"]*)"',
+    re.DOTALL
+)
+
+# NetworkManager D-Bus interface, set up in main(). When NetworkManager is
+# not running this stays None and scanning falls back to `iwlist`.
+_nm = None
+
+# Single background worker for Wi-Fi scans. Jobs run one at a time and hand
+# their results back to the GLib main loop with idle_add. Connecting needs
+# no worker: NetworkManager reports progress with D-Bus signals.
+_worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+CONNECT_TIMEOUT = 45  # Seconds to wait for the Wi-Fi device to activate
+MAX_WRITE = 1024  # Largest characteristic write accepted, in bytes
 
 # ── GATT Application Definition ──────────────────────────────────────────────
 # This is the main container for the GATT server.
@@ -34,6 +104,13 @@ class Application(dbus.service.Object):
         self.path = self.PATH_BASE
         self.services = []  # Will hold the list of GATT services
 
+        # GetManagedObjects reply, rebuilt only after the object tree changes
+        self._managed_cache = None
+
+        # Set once BlueZ has accepted the application. From then on,
+        # changes to the object tree are announced with ObjectManager signals.
+        self.registered = False
+
         # Register this object with D-Bus under the base path
         dbus.service.Object.__init__(self, bus, self.path)
 
@@ -45,13 +122,27 @@ class Application(dbus.service.Object):
 
     def add_service(self, svc):
         # Add a GATT service to the list of managed services
+        svc.application = self
         self.services.append(svc)
+        self._invalidate()
+
+        if self.registered:
+            self.InterfacesAdded(svc.get_path(), svc.get_properties())
+            for ch in svc.characteristics:
+                self.InterfacesAdded(ch.get_path(), ch.get_properties())
+
+    def _invalidate(self):
+        # Drop the cached GetManagedObjects reply after a tree change
+        self._managed_cache = None
 
     # D-Bus method that BlueZ calls to get all objects this application manages
     # Returns a dictionary mapping D-Bus paths to their properties
     @dbus.service.method('org.freedesktop.DBus.ObjectManager',
                          out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
+        if self._managed_cache is not None:
+            return self._managed_cache
+
         mapped = {}
         for service in self.services:
             # Add service properties
@@ -59,8 +150,26 @@ class Application(dbus.service.Object):
             # Add each characteristic's properties
             for ch in service.characteristics:
                 mapped[ch.get_path()] = ch.get_properties()
+
+        self._managed_cache = mapped
         return mapped
 
+    @dbus.service.signal('org.freedesktop.DBus.ObjectManager',
+                         signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        """
+        Announces an object added after registration, with its properties.
+        """
+        pass
+
+    @dbus.service.signal('org.freedesktop.DBus.ObjectManager',
+                         signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        """
+        Announces the interfaces of an object that has been removed.
+        """
+        pass
+
 # ── Service and Characteristic ───────────────────────────────────────────────
 
 class MyService(dbus.service.Object):
@@ -85,6 +194,12 @@ class MyService(dbus.service.Object):
         # List of characteristics this service provides
         self.characteristics = []
 
+        # Properties dict, built on first use once all characteristics exist
+        self._props = None
+
+        # Owning Application, set by Application.add_service()
+        self.application = None
+
         # Register this object on the D-Bus
         dbus.service.Object.__init__(self, bus, self.path)
 
@@ -118,22 +233,37 @@ class MyService(dbus.service.Object):
         - Whether it's primary
         - The list of characteristics under this service
         """
-        return {
-            GATT_SERVICE_IFACE: {
-                'UUID':    self.uuid,
-                'Primary': dbus.Boolean(self.primary),
-                'Characteristics': dbus.Array(
-                    [ch.get_path() for ch in self.characteristics],
-                    signature='o'  # "o" = D-Bus object path
-                )
+        if self._props is None:
+            self._props = {
+                GATT_SERVICE_IFACE: {
+                    'UUID':    self.uuid,
+                    'Primary': dbus.Boolean(self.primary),
+                    'Characteristics': dbus.Array(
+                        [ch.get_path() for ch in self.characteristics],
+                        signature='o'  # "o" = D-Bus object path
+                    )
+                }
             }
-        }
+        return self._props
 
     def add_characteristic(self, ch):
         """
         Adds a characteristic to the service.
         """
         self.characteristics.append(ch)
+        self._invalidate()
+
+        app = self.application
+        if app is not None and app.registered:
+            app.InterfacesAdded(ch.get_path(), ch.get_properties())
+
+    def _invalidate(self):
+        """
+        Drops cached properties after the characteristic list changes.
+        """
+        self._props = None
+        if self.application is not None:
+            self.application._invalidate()
 
 
 class NotifyCharacteristic(dbus.service.Object):
@@ -150,11 +280,30 @@ class NotifyCharacteristic(dbus.service.Object):
         self.service = service
 
         self.notifying = False   # Tracks whether a client has subscribed
-        self.value = []          # Most recent value sent
+        self.value = dbus.ByteArray(b'')  # Most recent value sent
+
+        # ATT MTU of the link; a notification carries at most mtu - 3 bytes.
+        # Starts at the BLE default and is updated from BlueZ call options.
+        self.mtu = 23
+
+        # Messages queued but not yet framed
+        self._pending = []
+        self._frames = collections.deque()  # Framed chunks not yet sent
+        self._flush_id = None    # GLib source id of the scheduled flush
 
         # Object path for this characteristic
         self.path = f"{service.path}/char_notify{index}"
 
+        # Properties dict is built once; only 'Value' changes afterwards
+        self._props = {
+            GATT_CHRC_IFACE: {
+                'UUID':    self.uuid,
+                'Service': self.service.get_path(),
+                'Flags':   dbus.Array(self.flags, signature='s'),
+                'Value':   self.value  # ByteArray is sent as 'ay'
+            }
+        }
+
         # Register this object on the D-Bus
         dbus.service.Object.__init__(self, bus, self.path)
 
@@ -172,14 +321,7 @@ class NotifyCharacteristic(dbus.service.Object):
         - Flags (notify only)
         - The current value (as an array of bytes)
         """
-        return {
-            GATT_CHRC_IFACE: {
-                'UUID':    self.uuid,
-                'Service': self.service.get_path(),
-                'Flags':   dbus.Array(self.flags, signature='s'),
-                'Value':   dbus.Array(self.value, signature='y')  # 'y' = byte
-            }
-        }
+        return self._props
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='', out_signature='')
     def StartNotify(self):
@@ -187,7 +329,7 @@ class NotifyCharacteristic(dbus.service.Object):
         Called by the client to subscribe to notifications.
         """
         self.notifying = True
-        print("🔔 StartNotify called", flush=True)
+        log.info("🔔 StartNotify called")
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='', out_signature='')
     def StopNotify(self):
@@ -195,19 +337,56 @@ class NotifyCharacteristic(dbus.service.Object):
         Called by the client to unsubscribe from notifications.
         """
         self.notifying = False
-        print("🔕 StopNotify called", flush=True)
+        log.info("🔕 StopNotify called")
+
+        # Drop anything not yet sent so a new subscriber starts on a
+        # message boundary
+        self._pending = []
+        self._frames.clear()
+        if self._flush_id is not None:
+            GLib.source_remove(self._flush_id)
+            self._flush_id = None
 
     def send_notification(self, message: str):
         """
         Server-side function to notify the client with new data.
-        Converts string to list of dbus.Bytes and sends via PropertiesChanged signal.
+        Each message is split into its own MTU-sized frames, which
+        _flush() sends one at a time.
+
+        A burst of messages shares a single idle flush source, but they
+        are never merged: batching stops at message and frame boundaries,
+        because every frame is its own BLE notification.
+
+        Each frame starts with a header byte: the low 7 bits are the
+        frame sequence number (wrapping at 128) and bit 0x80 marks the
+        last frame of a message.
         """
         if not self.notifying:
-            print("⚠️ Cannot notify, client hasn't subscribed", flush=True)
+            log.warning("⚠️ Cannot notify, client hasn't subscribed")
             return
 
-        # Convert message to bytes and update characteristic value
-        self.value = [dbus.Byte(b) for b in message.encode()]
+        self._pending.append(message.encode())
+        if self._flush_id is None:
+            self._flush_id = GLib.idle_add(self._flush)
+
+    def _flush(self):
+        """
+        Idle callback that emits one frame per main loop iteration,
+        so other D-Bus work is served between frames.
+        """
+        if not self._frames:
+            # Frame each queued message separately so the last-frame bit
+            # marks real message boundaries
+            for payload in self._pending:
+                chunks = _chunks(payload, max(self.mtu - 4, 1))  # 3 ATT + 1 header
+                for i, chunk in enumerate(chunks):
+                    last = 0x80 if i == len(chunks) - 1 else 0
+                    self._frames.append(bytes([(i & 0x7f) | last]) + chunk)
+            self._pending = []
+
+        # Wrap the raw bytes once instead of boxing each byte in dbus.Byte
+        self.value = dbus.ByteArray(self._frames.popleft())
+        self._props[GATT_CHRC_IFACE]['Value'] = self.value
 
         # Emit the PropertiesChanged signal to notify client
         self.PropertiesChanged(
@@ -216,6 +395,11 @@ class NotifyCharacteristic(dbus.service.Object):
             []
         )
 
+        if self._frames or self._pending:
+            return True  # Keep the idle source for the remaining frames
+        self._flush_id = None
+        return False
+
     @dbus.service.signal(dbus_interface='org.freedesktop.DBus.Properties',
                          signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
@@ -242,12 +426,21 @@ class MyCharacteristic(dbus.service.Object):
         self.flags = flags  # Example: ['read', 'write-without-response']
         self.service = service
 
-        # Default value (single byte set to 0)
-        self.value = [dbus.Byte(0x00)]
+        # Default value (single byte set to 0), kept as plain bytes
+        self.value = b'\x00'
 
         # D-Bus object path for this characteristic
         self.path = f"{service.path}/char{index}"
 
+        # Properties never change, so the dict is built once
+        self._props = {
+            GATT_CHRC_IFACE: {
+                'UUID':    self.uuid,
+                'Service': self.service.get_path(),
+                'Flags':   dbus.Array(self.flags, signature='s'),
+            }
+        }
+
         # Register with the D-Bus system
         dbus.service.Object.__init__(self, bus, self.path)
 
@@ -261,13 +454,7 @@ class MyCharacteristic(dbus.service.Object):
         - Associated service path
         - Supported flags (read/write/etc.)
         """
-        return {
-            GATT_CHRC_IFACE: {
-                'UUID':    self.uuid,
-                'Service': self.service.get_path(),
-                'Flags':   dbus.Array(self.flags, signature='s'),
-            }
-        }
+        return self._props
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}', out_signature='')
     def WriteValue(self, value, options):
@@ -276,96 +463,373 @@ class MyCharacteristic(dbus.service.Object):
         Parses incoming text and acts based on command.
 
         Expected formats:
-        - "SCAN_WIFI" (triggers a Wi-Fi scan)
+        - "SCAN_WIFI" (triggers a Wi-Fi scan, reusing a recent result)
+        - "SCAN_WIFI_FORCE" (triggers a fresh Wi-Fi scan, bypassing the cache)
         - JSON string with {"ssid": ..., "password": ...}
         """
 
+        # Refuse oversized writes before spending any work on them
+        if len(value) > MAX_WRITE:
+            log.warning("⚠️ Oversize write: %d bytes", len(value))
+            return
+
+        self.update_mtu(options)
+
+        # bytearray() builds the buffer in C instead of iterating dbus.Bytes
+        data = bytes(bytearray(value))
+
         try:
-            text = bytes(value).decode('utf-8')  # Convert byte array to string
-            print(f"📥 WriteValue: {text}", flush=True)
+            text = data.decode()
+            log.info("📥 WriteValue: %s", text)
 
-            if text == 'SCAN_WIFI':
-                # Run a scan using iwlist
-                try:
-                    networks = scan_networks()
+            if text in ('SCAN_WIFI', 'SCAN_WIFI_FORCE'):
+                # Scan in the background so D-Bus calls keep being served
+                _worker.submit(self.scan_job, text == 'SCAN_WIFI_FORCE')
+                return
 
-                    if not networks:
-                        print('not networks', flush=True)
-                        raise Exception('Failed to scan networks')
+            # Only hand text that can be JSON to the parser, so unknown
+            # commands don't go through a JSONDecodeError
+            stripped = text.lstrip()
+            if stripped[:1] in ('{', '['):
+                self.handle_json(json.loads(stripped))
+            else:
+                log.error("❌ Unknown command: %s", text)
 
-                    print(networks, flush=True)
+        except json.JSONDecodeError as e:
+            log.error("❌ JSON decode error: %s", e)
+        except Exception as e:
+            log.error("%s", e)
+            log.error("📥 WriteValue (raw): %s", list(data))
 
-                    # Convert list of networks to JSON string
-                    json_str = json.dumps(networks)
+        # Store last written value
+        self.value = data
 
-                    # Send results to the client via notify characteristic
-                    self.service.notify_char.send_notification(json_str)
+    def handle_json(self, data):
+        """
+        Handles a JSON write with Wi-Fi credentials:
+        {"ssid": ..., "password": ...}
+        """
+        log.info("✅ Parsed JSON: %s", data)
 
-                except Exception as e:
-                    print(f'Some error happend: {e}', e, flush=True)
-                return
+        ssid = data.get('ssid')
+        password = data.get('password')
+        log.info("📡 SSID: %s, 🔑 Password: %s", ssid, password)
 
-            # Try to parse incoming data as JSON
-            data = json.loads(text)
-            print(f"✅ Parsed JSON: {data}", flush=True)
+        if not ssid or not password:
+            log.error("❌ Missing SSID or password")
+            return
 
-            ssid = data.get('ssid')
-            password = data.get('password')
-            print(f"📡 SSID: {ssid}, 🔑 Password: {password}", flush=True)
+        # Share the last SCAN_WIFI result rather than scanning again
+        log.info("🔹 Notifying via Bluetooth...")
+        self.service.notify_char.send_notification(
+            json.dumps(_scan_cache["networks"]))
 
-            if not ssid or not password:
-                print("❌ Missing SSID or password", flush=True)
-                return
+        # Connecting takes seconds, so it runs in the background
+        self.start_connect(ssid, password)
 
-            # Run a Wi-Fi scan and optionally notify
-            command = "sudo iwlist scan | grep 'ESSID'"
-            result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    def update_mtu(self, options):
+        """
+        Passes the link MTU that BlueZ reports in call options
+        on to the notify characteristic, which frames by it.
+        """
+        if 'mtu' in options:
+            self.service.notify_char.mtu = int(options['mtu'])
 
-            if result.returncode == 0:
-                output = result.stdout.strip()
-                if not output:
-                    output = "No ESSIDs found"
-            else:
-                output = f"Error: {result.stderr.strip()}"
+    def notify(self, message):
+        """
+        Sends a notification from a worker thread.
+        The D-Bus signal itself is emitted on the main loop thread.
+        """
+        GLib.idle_add(self.service.notify_char.send_notification, message)
 
-            print("🔹 Notifying via Bluetooth...", flush=True)
-            self.service.notify_char.send_notification(output)
+    def scan_job(self, force=False):
+        """
+        Runs a Wi-Fi scan on the worker thread and notifies the result.
+        With force=True the scan cache is bypassed.
+        """
+        try:
+            networks = scan_networks(force)
 
-            # Connect to Wi-Fi using NetworkManager CLI
-            command = f"sudo nmcli device wifi connect '{ssid}' password '{password}'"
-            result = subprocess.run(command, shell=True, capture_output=True, text=True)
+            if not networks:
+                log.error('not networks')
+                raise Exception('Failed to scan networks')
 
-            if result.returncode == 0:
-                print("✅ Wi-Fi credentials accepted", flush=True)
-                self.service.notify_char.send_notification("✅ Connected to Wi-Fi")
-            else:
-                print("❌ Failed to connect to Wi-Fi", flush=True)
-                self.service.notify_char.send_notification("❌ Failed to connect")
-                print("✅ Wi-Fi config updated. Reconnect on next boot or reconfigure now.", flush=True)
+            log.info("%s", networks)
+
+            # Convert list of networks to JSON string
+            json_str = json.dumps(networks)
+
+            # Send results to the client via notify characteristic
+            self.notify(json_str)
 
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON decode error: {e}", flush=True)
         except Exception as e:
-            print(e, flush=True)
-            print(f"📥 WriteValue (raw): {list(value)}", flush=True)
+            log.error('Some error happend: %s', e)
 
-        # Store last written value
-        self.value = value
+    def start_connect(self, ssid, password):
+        """
+        Asks NetworkManager to connect to Wi-Fi without waiting for it.
+        The outcome arrives as StateChanged signals from the active
+        connection this call starts and is reported by connect_finished().
+        """
+        if _nm is None:
+            log.error("❌ NetworkManager unavailable, cannot connect")
+            self.service.notify_char.send_notification("❌ Failed to connect")
+            return
+
+        state = {'done': False, 'match': None, 'timeout_id': None,
+                 'created': None, 'updated': None, 'active': None}
+        state['timeout_id'] = GLib.timeout_add_seconds(
+            CONNECT_TIMEOUT, self.connect_timeout, state)
+
+        # The device, access point and profile lookups take many D-Bus
+        # round trips, so they run on the worker thread
+        _worker.submit(self.connect_job, state, ssid, password)
+
+    def connect_job(self, state, ssid, password):
+        """
+        Looks up what a connect needs on the worker thread, then hands
+        the activation itself back to the main loop.
+        """
+        # dbus.SystemBus() returns the shared connection already opened in main()
+        bus = dbus.SystemBus()
+
+        try:
+            devices = find_wifi_devices(bus)
+            if not devices:
+                GLib.idle_add(self.connect_finished, state, False,
+                              'no Wi-Fi device found')
+                return
+            dev_path = devices[0]
+
+            ap_path, ap_props = find_access_point(bus, dev_path, ssid)
+            profile = find_wifi_profile(bus, ssid)
+            original = None
+            if profile is not None:
+                original = saved_profile_settings(dbus.Interface(
+                    bus.get_object(NM_SERVICE_NAME, profile[0]),
+                    NM_SETTINGS_CONNECTION_IFACE))
+        except dbus.exceptions.DBusException as e:
+            GLib.idle_add(self.connect_finished, state, False, e)
+            return
+        key_mgmt, secrets = wifi_security(ap_props, password)
+
+        if profile is not None:
+            # Reuse the saved profile for this SSID with the new secret
+            # rather than piling up duplicates
+            conn_path, settings = profile
+            if key_mgmt is not None:
+                security = settings.setdefault('802-11-wireless-security', {})
+                security.update(secrets)
+                security.setdefault('key-mgmt', key_mgmt)
+        else:
+            # NetworkManager fills in the connection id, uuid and IP settings.
+            # Given the access point it also works out key-mgmt from its
+            # flags; only a network that isn't in the scan list needs it
+            # spelled out.
+            conn_path = None
+            settings = dbus.Dictionary({
+                '802-11-wireless': dbus.Dictionary({
+                    'ssid': dbus.ByteArray(ssid.encode()),
+                }, signature='sv'),
+            }, signature='sa{sv}')
+            if key_mgmt is not None:
+                security = dict(secrets)
+                if ap_props is None:
+                    security['key-mgmt'] = key_mgmt
+                settings['802-11-wireless-security'] = dbus.Dictionary(
+                    security, signature='sv')
+
+        GLib.idle_add(self.activate, state, dev_path, ap_path,
+                      conn_path, settings, original)
+
+    def activate(self, state, dev_path, ap_path, conn_path, settings, original):
+        """
+        Starts the activation on the main loop with asynchronous calls.
+        `conn_path` is the saved profile to reuse, or None to add one.
+        """
+        if state['done']:
+            return False  # Timed out while looking things up
+
+        if conn_path is None:
+            _nm.AddAndActivateConnection(
+                settings, dev_path, ap_path,
+                reply_handler=lambda created, active_path:
+                    self.activation_started(state, active_path, created),
+                error_handler=lambda e: self.connect_finished(state, False, e)
+            )
+            return False
+
+        # The new secret is only applied in memory; it is written to
+        # disk by connect_finished() once the connection is up, and the
+        # original settings are put back if it fails
+        state['updated'] = (conn_path, original)
+        conn = dbus.Interface(
+            dbus.SystemBus().get_object(NM_SERVICE_NAME, conn_path),
+            NM_SETTINGS_CONNECTION_IFACE)
+        conn.UpdateUnsaved(
+            settings,
+            reply_handler=lambda: _nm.ActivateConnection(
+                conn_path, dev_path, ap_path,
+                reply_handler=lambda active_path:
+                    self.activation_started(state, active_path),
+                error_handler=lambda e: self.connect_finished(state, False, e)
+            ),
+            error_handler=lambda e: self.connect_finished(state, False, e)
+        )
+        return False
+
+    def activation_started(self, state, active_path, created=None):
+        """
+        Reply handler for the activate call. Watches the returned active
+        connection, so transitions of an activation that was already in
+        progress on the device are never mistaken for this one.
+        `created` is the profile path when this attempt added a new one.
+        """
+        state['created'] = created
+        state['active'] = active_path
+        if state['done']:
+            # Timed out before NetworkManager replied
+            self.deactivate(state)
+            self.undo_profile_changes(state)
+            return
+
+        bus = dbus.SystemBus()
+        state['match'] = bus.add_signal_receiver(
+            lambda new, reason: self.connect_state_changed(state, new),
+            signal_name='StateChanged',
+            dbus_interface=NM_ACTIVE_CONN_IFACE,
+            bus_name=NM_SERVICE_NAME,
+            path=active_path
+        )
+
+        # The activation may have settled before the receiver was added.
+        # If the active connection is already gone, it did not come up.
+        dbus.Interface(
+            bus.get_object(NM_SERVICE_NAME, active_path), DBUS_PROP_IFACE
+        ).Get(
+            NM_ACTIVE_CONN_IFACE, 'State',
+            reply_handler=lambda current: self.connect_state_changed(state, current),
+            error_handler=lambda e: self.connect_finished(state, False, e)
+        )
+
+    def connect_state_changed(self, state, new_state):
+        """
+        Handles a StateChanged signal from the active connection.
+        """
+        if new_state == NM_ACTIVE_CONNECTION_STATE_ACTIVATED:
+            self.connect_finished(state, True)
+        elif new_state == NM_ACTIVE_CONNECTION_STATE_DEACTIVATED:
+            self.connect_finished(state, False)
+
+    def connect_timeout(self, state):
+        """
+        Fires when the connection is neither up nor down in CONNECT_TIMEOUT seconds.
+        """
+        state['timeout_id'] = None
+        # Stop the activation so it can't still succeed after the client
+        # was told it failed
+        self.deactivate(state)
+        self.connect_finished(state, False, 'timed out')
+        return False
+
+    def deactivate(self, state):
+        """
+        Deactivates the active connection this attempt started, if any.
+        """
+        if state['active'] is None:
+            return
+        _nm.DeactivateConnection(
+            state['active'],
+            reply_handler=lambda: None,
+            error_handler=lambda e: log.warning(
+                "Failed to deactivate Wi-Fi connection: %s", e)
+        )
+
+    def connect_finished(self, state, success, error=None):
+        """
+        Reports the connect outcome once and stops watching the connection.
+        """
+        if state['done']:
+            return
+        state['done'] = True
+
+        if state['match'] is not None:
+            state['match'].remove()
+        if state['timeout_id'] is not None:
+            GLib.source_remove(state['timeout_id'])
+
+        if success:
+            log.info("✅ Wi-Fi credentials accepted")
+            self.service.notify_char.send_notification("✅ Connected to Wi-Fi")
+            self.save_updated_profile(state)
+            return
+
+        log.error("❌ Failed to connect to Wi-Fi: %s", error)
+        self.service.notify_char.send_notification("❌ Failed to connect")
+
+        self.undo_profile_changes(state)
+
+    def save_updated_profile(self, state):
+        """
+        Writes a reused profile's new, now verified, secret to disk.
+        """
+        if state['updated'] is None:
+            return
+        conn_path, _ = state['updated']
+        conn = dbus.Interface(
+            dbus.SystemBus().get_object(NM_SERVICE_NAME, conn_path),
+            NM_SETTINGS_CONNECTION_IFACE)
+        conn.Save(
+            reply_handler=lambda: None,
+            error_handler=lambda e: log.warning(
+                "Failed to save Wi-Fi profile: %s", e)
+        )
+
+    def undo_profile_changes(self, state):
+        """
+        Reverts what a failed attempt did to saved profiles, so bad
+        credentials aren't left behind for NetworkManager to autoconnect
+        with: a profile this attempt added is deleted, and a reused
+        profile gets its original settings back (its file was never
+        touched).
+        """
+        bus = dbus.SystemBus()
+        if state['created'] is not None:
+            conn = dbus.Interface(
+                bus.get_object(NM_SERVICE_NAME, state['created']),
+                NM_SETTINGS_CONNECTION_IFACE)
+            conn.Delete(
+                reply_handler=lambda: None,
+                error_handler=lambda e: log.warning(
+                    "Failed to delete Wi-Fi profile: %s", e)
+            )
+        if state['updated'] is not None:
+            conn_path, original = state['updated']
+            conn = dbus.Interface(
+                bus.get_object(NM_SERVICE_NAME, conn_path),
+                NM_SETTINGS_CONNECTION_IFACE)
+            conn.UpdateUnsaved(
+                original,
+                reply_handler=lambda: None,
+                error_handler=lambda e: log.warning(
+                    "Failed to restore Wi-Fi profile: %s", e)
+            )
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='ay')
     def ReadValue(self, options):
         """
         Called when a BLE client reads the value of this characteristic.
         """
-        print("📤 ReadValue called", flush=True)
-        return self.value
+        log.info("📤 ReadValue called")
+        self.update_mtu(options)
+        return dbus.ByteArray(self.value)
 
     @dbus.service.method('org.freedesktop.DBus.Properties', in_signature='ss', out_signature='v')
     def Get(self, interface, prop):
         """
         Called by BlueZ to get a specific property of this characteristic.
         """
-        return self.get_properties()[interface][prop]
+        return self._props[interface][prop]
 
     @dbus.service.method('org.freedesktop.DBus.Properties',
                          in_signature='s', out_signature='a{sv}')
@@ -375,7 +839,7 @@ class MyCharacteristic(dbus.service.Object):
         """
         if interface != GATT_CHRC_IFACE:
             raise dbus.exceptions.DBusException('Invalid interface')
-        return self.get_properties()[interface]
+        return self._props[interface]
 
 
 # ── Advertisement ─────────────────────────────────────────────────────────────
@@ -411,6 +875,14 @@ class Advertisement(dbus.service.Object):
         # 'tx-power' includes the transmit power level in the advertisement.
         self.includes = ['tx-power']
 
+        # Advertised properties are constant, so the dict is built once
+        self._props = {
+            'Type':          'peripheral',  # We act as a BLE peripheral device
+            'ServiceUUIDs':  dbus.Array(self.service_uuids, signature='s'),  # Services advertised
+            'LocalName':     self.local_name,  # Friendly device name
+            'Includes':      dbus.Array(self.includes, signature='s'),  # Extra fields to include
+        }
+
         # Register this object on the D-Bus at the path self.path
         dbus.service.Object.__init__(self, bus, self.path)
 
@@ -430,12 +902,7 @@ class Advertisement(dbus.service.Object):
         if interface != ADVERTISING_IFACE:
             raise dbus.exceptions.DBusException('Invalid interface')
 
-        return {
-            'Type':          'peripheral',  # We act as a BLE peripheral device
-            'ServiceUUIDs':  dbus.Array(self.service_uuids, signature='s'),  # Services advertised
-            'LocalName':     self.local_name,  # Friendly device name
-            'Includes':      dbus.Array(self.includes, signature='s'),  # Extra fields to include
-        }
+        return self._props
 
     @dbus.service.method(ADVERTISING_IFACE, in_signature='', out_signature='')
     def Release(self):
@@ -444,7 +911,7 @@ class Advertisement(dbus.service.Object):
         release this advertisement object.
         Useful for cleanup or logging.
         """
-        print("❌ Advertisement released", flush=True)
+        log.info("❌ Advertisement released")
 
 
 # ── Helpers & Main ───────────────────────────────────────────────────────────
@@ -471,35 +938,226 @@ def find_adapter(bus):
             return path
     return None
 
-def register_app_cb():
+def _chunks(data, size):
+    """
+    Splits bytes into pieces of at most `size` bytes.
+    Always returns at least one (possibly empty) piece.
+    """
+    return [data[i:i + size] for i in range(0, len(data), size)] or [b'']
+
+def register_app_cb(app):
     """
     Callback invoked by BlueZ upon successful registration of the GATT application.
+    From now on, changes to the object tree are announced with InterfacesAdded.
     """
-    print("✅ GATT application registered", flush=True)
+    app.registered = True
+    log.info("✅ GATT application registered")
 
 def register_app_error_cb(error):
     """
     Callback invoked if GATT application registration fails.
     """
-    print("❌ Failed to register application:", error, flush=True)
+    log.error("❌ Failed to register application: %s", error)
 
 def register_ad_cb():
     """
     Callback invoked when the advertisement is successfully registered with BlueZ.
     """
-    print("📣 Advertisement registered", flush=True)
+    log.info("📣 Advertisement registered")
 
 def register_ad_error_cb(error):
     """
     Callback invoked if advertisement registration fails.
     """
-    print("❌ Failed to register advertisement:", error, flush=True)
+    log.error("❌ Failed to register advertisement: %s", error)
 
 # ── Wi-Fi Scanner ─────────────────────────────────────────────────────────────
-# This function scans available Wi-Fi networks using the `iwlist` command
-# and parses the output to extract ESSIDs (names) and MAC addresses.
+# These functions list available Wi-Fi networks with their ESSIDs (names)
+# and MAC addresses. NetworkManager is queried over D-Bus when available;
+# otherwise the output of the `iwlist` command is parsed.
+# Results are cached for SCAN_CACHE_TTL seconds; pass force=True to rescan.
+
+def scan_networks(force=False):
+    if not force and time.monotonic() - _scan_cache["ts"] < SCAN_CACHE_TTL:
+        return _scan_cache["networks"]
+
+    if _nm is not None:
+        networks = scan_networks_nm()
+    else:
+        networks = scan_networks_iwlist()
+
+    # Only successful scans are cached so a failure is retried next time
+    if networks:
+        _scan_cache["ts"] = time.monotonic()
+        _scan_cache["networks"] = networks
 
-def scan_networks():
+    return networks
+
+def unique_networks(pairs):
+    """
+    Turns (address, essid) pairs into the network list sent to clients,
+    in one pass. Keeps the first address seen for each non-empty ESSID.
+    """
+    seen = {}
+    for addr, essid in pairs:
+        if essid and essid not in seen:
+            seen[essid] = addr
+    return [{"address": addr, "essid": essid} for essid, addr in seen.items()]
+
+def find_wifi_devices(bus):
+    """
+    Returns the D-Bus paths of all NetworkManager Wi-Fi devices.
+    """
+    devices = []
+    for dev_path in _nm.GetDevices():
+        dev_props = dbus.Interface(
+            bus.get_object(NM_SERVICE_NAME, dev_path), DBUS_PROP_IFACE)
+        if dev_props.Get(NM_DEVICE_IFACE, 'DeviceType') == NM_DEVICE_TYPE_WIFI:
+            devices.append(dev_path)
+    return devices
+
+def saved_profile_settings(conn):
+    """
+    Returns a saved profile's settings including its Wi-Fi secrets, so
+    they can be put back unchanged. Secrets that NetworkManager doesn't
+    hold itself (e.g. agent-owned ones) are left out.
+    """
+    settings = conn.GetSettings()
+    if '802-11-wireless-security' in settings:
+        try:
+            secrets = conn.GetSecrets('802-11-wireless-security')
+        except dbus.exceptions.DBusException as e:
+            log.warning("Failed to read Wi-Fi profile secrets: %s", e)
+            secrets = {}
+        for name, values in secrets.items():
+            settings.setdefault(name, {}).update(values)
+    return settings
+
+def find_access_point(bus, dev_path, ssid):
+    """
+    Finds the access point broadcasting `ssid` on a Wi-Fi device.
+    Returns (path, properties), or ('/', None) when it isn't in the scan
+    list, which lets NetworkManager pick one itself.
+    """
+    wireless = dbus.Interface(
+        bus.get_object(NM_SERVICE_NAME, dev_path), NM_WIRELESS_IFACE)
+    for ap_path in wireless.GetAccessPoints():
+        ap_props = dbus.Interface(
+            bus.get_object(NM_SERVICE_NAME, ap_path), DBUS_PROP_IFACE
+        ).GetAll(NM_AP_IFACE)
+        if bytes(bytearray(ap_props['Ssid'])) == ssid.encode():
+            return ap_path, ap_props
+    return dbus.ObjectPath('/'), None
+
+def wifi_security(ap_props, password):
+    """
+    Picks the security settings for an access point from its flags.
+    Returns (key_mgmt, secrets); key_mgmt is None for an open network.
+    Without access point properties (hidden network) WPA-PSK is assumed.
+    """
+    if ap_props is None:
+        return 'wpa-psk', {'psk': password}
+
+    rsn_flags = ap_props['RsnFlags']
+    if rsn_flags & NM_AP_SEC_KEY_MGMT_SAE and not rsn_flags & NM_AP_SEC_KEY_MGMT_PSK:
+        return 'sae', {'psk': password}
+    if rsn_flags or ap_props['WpaFlags']:
+        return 'wpa-psk', {'psk': password}
+    if ap_props['Flags'] & NM_AP_FLAGS_PRIVACY:
+        return 'none', {'wep-key0': password}  # WEP
+    return None, {}
+
+def find_wifi_profile(bus, ssid):
+    """
+    Returns (path, settings) of the first saved Wi-Fi profile for `ssid`,
+    or None when there is none.
+    """
+    settings_iface = dbus.Interface(
+        bus.get_object(NM_SERVICE_NAME, NM_SETTINGS_PATH), NM_SETTINGS_IFACE)
+    for conn_path in settings_iface.ListConnections():
+        conn = dbus.Interface(
+            bus.get_object(NM_SERVICE_NAME, conn_path),
+            NM_SETTINGS_CONNECTION_IFACE)
+        settings = conn.GetSettings()
+        wireless = settings.get('802-11-wireless')
+        if wireless and bytes(bytearray(wireless.get('ssid', []))) == ssid.encode():
+            return conn_path, settings
+    return None
+
+def request_scan(bus, dev_path):
+    """
+    Asks a Wi-Fi device to rescan, then blocks (on the worker thread) until
+    NetworkManager signals a new LastScan, or SCAN_WAIT_TIMEOUT seconds
+    have passed. NetworkManager older than 1.12 has no LastScan property;
+    there the rescan is still requested but not waited for.
+    """
+    dev = bus.get_object(NM_SERVICE_NAME, dev_path)
+    finished = threading.Event()
+
+    def on_properties_changed(interface, changed, invalidated):
+        # Runs on the main loop thread
+        if interface == NM_WIRELESS_IFACE and 'LastScan' in changed:
+            finished.set()
+
+    # Subscribe first so a scan that finishes right away is not missed
+    match = bus.add_signal_receiver(
+        on_properties_changed,
+        signal_name='PropertiesChanged',
+        dbus_interface=DBUS_PROP_IFACE,
+        bus_name=NM_SERVICE_NAME,
+        path=dev_path
+    )
+    try:
+        try:
+            # NM rejects this right after a scan; the current list is used then
+            dbus.Interface(dev, NM_WIRELESS_IFACE).RequestScan({})
+        except dbus.exceptions.DBusException as e:
+            log.warning("Wi-Fi rescan not started: %s", e)
+            return
+
+        try:
+            dbus.Interface(dev, DBUS_PROP_IFACE).Get(NM_WIRELESS_IFACE, 'LastScan')
+        except dbus.exceptions.DBusException:
+            return  # No LastScan to wait for
+
+        if not finished.wait(SCAN_WAIT_TIMEOUT):
+            log.warning("Wi-Fi rescan did not finish, using previous results")
+    finally:
+        match.remove()
+
+def scan_networks_nm():
+    """
+    Lists access points known to NetworkManager on every Wi-Fi device.
+    Returns structured data straight from D-Bus, no subprocess or parsing.
+    """
+    # dbus.SystemBus() returns the shared connection already opened in main()
+    bus = dbus.SystemBus()
+
+    try:
+        pairs = []
+        for dev_path in find_wifi_devices(bus):
+            request_scan(bus, dev_path)
+            wireless = dbus.Interface(
+                bus.get_object(NM_SERVICE_NAME, dev_path), NM_WIRELESS_IFACE)
+
+            for ap_path in wireless.GetAccessPoints():
+                ap_props = dbus.Interface(
+                    bus.get_object(NM_SERVICE_NAME, ap_path), DBUS_PROP_IFACE)
+                ssid = ap_props.Get(NM_AP_IFACE, 'Ssid')
+                essid = bytes(bytearray(ssid)).decode('utf-8', 'replace')
+                addr = str(ap_props.Get(NM_AP_IFACE, 'HwAddress'))
+                pairs.append((addr, essid))
+
+        return unique_networks(pairs)
+
+    except dbus.exceptions.DBusException as e:
+        log.error("Failed to scan Wi-Fi: %s", e)
+        return []
+
+def scan_networks_iwlist():
+    """
+    Fallback scanner that runs `iwlist` and parses its text output.
+    """
     try:
         # Run the Wi-Fi scan command using subprocess
         result = subprocess.run(
@@ -510,35 +1168,21 @@ def scan_networks():
         )
         output = result.stdout
 
-        # Regex to extract MAC addresses and ESSIDs
-        cell_re = re.compile(r'Cell \d+ - Address: ([\da-fA-F:]{17})')
-        essid_re = re.compile(r'ESSID:"(.*?)"')
-
-        addresses = cell_re.findall(output)
-        essids = essid_re.findall(output)
-
-        seen_essids = set()
-        unique_networks = []
-
-        # Avoid listing duplicate ESSIDs
-        for addr, essid in zip(addresses, essids):
-            if essid not in seen_essids and essid != "":
-                seen_essids.add(essid)
-                unique_networks.append({
-                    "address": addr,
-                    "essid": essid
-                })
-
-        return unique_networks
+        # Stream (address, essid) pairs without building an intermediate list
+        return unique_networks(m.groups() for m in _CELL_RE.finditer(output))
 
     except subprocess.CalledProcessError as e:
-        print("Failed to scan Wi-Fi:", e, flush=True)
+        log.error("Failed to scan Wi-Fi: %s", e)
         return []
 
 def main():
+    global _nm
+
     # Use the GLib main loop for handling asynchronous D-Bus events.
     # This integration is necessary for BlueZ's asynchronous APIs.
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    # The Wi-Fi worker thread makes D-Bus calls too
+    dbus.mainloop.glib.threads_init()
 
     # Connect to the system bus (used for system services like BlueZ)
     bus = dbus.SystemBus()
@@ -546,9 +1190,18 @@ def main():
     # Find the Bluetooth adapter's D-Bus object path (e.g., '/org/bluez/hci0')
     adapter = find_adapter(bus)
     if not adapter:
-        print("❌ No Bluetooth adapter found", flush=True)
+        log.error("❌ No Bluetooth adapter found")
         return  # Exit if no Bluetooth hardware is available
 
+    # Keep a NetworkManager handle for Wi-Fi scanning and connecting over D-Bus
+    try:
+        _nm = dbus.Interface(
+            bus.get_object(NM_SERVICE_NAME, NM_PATH),
+            NM_IFACE
+        )
+    except dbus.exceptions.DBusException as e:
+        log.warning("⚠️ NetworkManager unavailable, scanning with iwlist only: %s", e)
+
     # Create instances of your GATT application and advertisement
     app = Application(bus)
     adv = Advertisement(bus, 0)
@@ -568,16 +1221,16 @@ def main():
     # Sleep a bit to let BlueZ settle and be ready for registration calls
     time.sleep(1)
 
-    print("ℹ️  Registering GATT application …", flush=True)
+    log.info("ℹ️  Registering GATT application …")
     # Register your GATT Application with BlueZ asynchronously
     svc_m.RegisterApplication(
         app.get_path(),
         {},  # Options dictionary, usually empty
-        reply_handler=register_app_cb,
+        reply_handler=lambda: register_app_cb(app),
         error_handler=register_app_error_cb
     )
 
-    print("ℹ️  Registering Advertisement …", flush=True)
+    log.info("ℹ️  Registering Advertisement …")
     # Register your Advertisement object with BlueZ asynchronously
     adv_m.RegisterAdvertisement(
         adv.get_path(),
@@ -591,4 +1244,8 @@ def main():
     GLib.MainLoop().run()
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        # Write out any records still queued before exiting
+        _log_listener.stop()